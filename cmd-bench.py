@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+# Measures command-to-wire latency while a telemetry flood is being handled
+# on the main client's network loop, publishing commands either on that same
+# client or through the dedicated command lane. Needs a running broker, the
+# last argument is the simulated handling time per telemetry message:
+#   ./cmd-bench.py [server] [port] [user] [password] [handler ms]
+
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+spec = importlib.util.spec_from_file_location(
+    "mqtt_poly", os.path.join(here, "mqtt-poly.py")
+)
+mqtt_poly = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(mqtt_poly)
+mqtt = mqtt_poly.mqtt
+
+TELEMETRY = json.dumps(
+    {
+        "Time": "2021-01-19T12:00:00",
+        "ENERGY": {
+            "Total": 12.345,
+            "Power": 57,
+            "Factor": 0.9,
+            "Voltage": 121,
+            "Current": 0.52,
+        },
+    }
+)
+
+
+def connect(broker, on_message=None, topic=None):
+    client = mqtt.Client()
+    client.username_pw_set(broker["user"], broker["password"])
+    if on_message is not None:
+        client.on_message = on_message
+    client.connect(broker["server"], broker["port"], 10)
+    if topic is not None:
+        client.subscribe(topic)
+    client.loop_start()
+    return client
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run(broker, use_lane, handler, commands=100, interval=0.05):
+    sent = {}
+    latency = []
+    stopping = threading.Event()
+
+    # Stand-in for Controller._on_message: decode and do some node work
+    def on_telemetry(client, userdata, message):
+        data = json.loads(message.payload.decode("utf-8"))
+        for key in data["ENERGY"]:
+            str(data["ENERGY"][key])
+        time.sleep(handler)
+
+    def on_command(client, userdata, message):
+        latency.append(time.perf_counter() - sent[int(message.payload)])
+
+    def flood(client):
+        while not stopping.is_set():
+            client.publish("bench/tele/SENSOR", TELEMETRY)
+            time.sleep(0.0002)
+
+    ingest = connect(broker, on_telemetry, "bench/tele/#")
+    probe = connect(broker, on_command, "bench/cmnd/#")
+    flooder = connect(broker)
+    lane = None
+    if use_lane:
+        lane = mqtt_poly.CommandLane(broker, ingest.publish)
+        lane.start()
+    time.sleep(1)
+    threading.Thread(target=flood, args=(flooder,), daemon=True).start()
+    time.sleep(1)
+    for i in range(commands):
+        sent[i] = time.perf_counter()
+        if lane is not None:
+            lane.publish("bench/cmnd/POWER", str(i))
+        else:
+            ingest.publish("bench/cmnd/POWER", str(i))
+        time.sleep(interval)
+    time.sleep(2)
+    stopping.set()
+    for client in (ingest, probe, flooder):
+        client.loop_stop()
+        client.disconnect()
+    if lane is not None:
+        lane.stop()
+    return latency
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:] + [None] * 5
+    broker = {
+        "server": args[0] or "localhost",
+        "port": int(args[1] or 1883),
+        "user": args[2],
+        "password": args[3],
+        "client_id": None,
+        "qos": 0,
+    }
+    handler = float(args[4] or 2) / 1000
+    print(
+        "{:<14} {:>5} {:>9} {:>9} {:>9}".format(
+            "mode", "n", "p50 ms", "p95 ms", "max ms"
+        )
+    )
+    for name, use_lane in (("shared client", False), ("command lane", True)):
+        latency = [ms * 1000 for ms in run(broker, use_lane, handler)]
+        if not latency:
+            print("{:<14} no commands received".format(name))
+            continue
+        print(
+            "{:<14} {:>5} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+                name,
+                len(latency),
+                percentile(latency, 50),
+                percentile(latency, 95),
+                max(latency),
+            )
+        )
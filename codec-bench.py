@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+# Compares the payload codecs available to mqtt-poly.py on representative
+# Tasmota and RGBW strip payloads. Run from the nodeserver directory:
+#   ./codec-bench.py [iterations]
+
+import importlib.util
+import os
+import sys
+import timeit
+
+here = os.path.dirname(os.path.abspath(__file__))
+spec = importlib.util.spec_from_file_location(
+    "mqtt_poly", os.path.join(here, "mqtt-poly.py")
+)
+mqtt_poly = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(mqtt_poly)
+
+PAYLOADS = {
+    "tasmota STATE": {
+        "Time": "2021-01-19T12:00:00",
+        "Uptime": "0T01:02:03",
+        "UptimeSec": 3723,
+        "Heap": 26,
+        "SleepMode": "Dynamic",
+        "Sleep": 50,
+        "LoadAvg": 19,
+        "MqttCount": 1,
+        "POWER": "ON",
+        "Wifi": {
+            "AP": 1,
+            "SSId": "iot",
+            "BSSId": "AA:BB:CC:DD:EE:FF",
+            "Channel": 6,
+            "RSSI": 76,
+            "Signal": -62,
+            "LinkCount": 1,
+            "Downtime": "0T00:00:03",
+        },
+    },
+    "tasmota S31 SENSOR": {
+        "Time": "2021-01-19T12:00:00",
+        "ENERGY": {
+            "TotalStartTime": "2020-12-01T10:00:00",
+            "Total": 12.345,
+            "Yesterday": 0.512,
+            "Today": 0.123,
+            "Period": 1,
+            "Power": 57,
+            "ApparentPower": 63,
+            "ReactivePower": 27,
+            "Factor": 0.9,
+            "Voltage": 121,
+            "Current": 0.52,
+        },
+    },
+    "tasmota BME280 SENSOR": {
+        "Time": "2021-01-19T12:00:00",
+        "BME280": {"Temperature": 71.3, "Humidity": 41.2, "Pressure": 1013.2},
+        "PressureUnit": "hPa",
+        "TempUnit": "F",
+    },
+    "RGBW strip": {
+        "state": "ON",
+        "br": 200,
+        "c": {"r": 255, "g": 120, "b": 10, "w": 0},
+        "pgm": 3,
+    },
+}
+
+
+def bench(codec, data, number):
+    encoded = codec.encode(data)
+    raw = encoded.encode("utf-8") if isinstance(encoded, str) else encoded
+    # Text codecs pay for the UTF-8 decode in _on_message as well
+    if codec.text:
+        decode = lambda: codec.decode(raw.decode("utf-8"))
+    else:
+        decode = lambda: codec.decode(raw)
+    encode_us = timeit.timeit(lambda: codec.encode(data), number=number) / number
+    decode_us = timeit.timeit(decode, number=number) / number
+    return len(raw), encode_us * 1000000, decode_us * 1000000
+
+
+if __name__ == "__main__":
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    codecs = [name for name in mqtt_poly.CODECS if name != "auto"]
+    missing = {"msgpack", "cbor"} - set(codecs)
+    if missing:
+        print("Not installed: {}".format(", ".join(sorted(missing))))
+    print(
+        "{:<22} {:<8} {:>6} {:>11} {:>11}".format(
+            "payload", "codec", "bytes", "encode us", "decode us"
+        )
+    )
+    for pname, data in PAYLOADS.items():
+        for cname in codecs:
+            size, enc, dec = bench(mqtt_poly.CODECS[cname], data, number)
+            print(
+                "{:<22} {:<8} {:>6} {:>11.2f} {:>11.2f}".format(
+                    pname, cname, size, enc, dec
+                )
+            )
@@ -6,9 +6,312 @@ import logging
 import paho.mqtt.client as mqtt
 import json
 import yaml
+import time
+import threading
+import os
+import cProfile
+import tracemalloc
+import multiprocessing
+import queue
+import sqlite3
+from collections import deque, OrderedDict
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
 
 LOGGER = polyinterface.LOGGER
 
+# Command round-trip histogram bucket upper bounds, milliseconds
+RTT_BUCKETS = [25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+
+# Payload codecs, selected per device with "codec" in the devlist/devfile.
+# Text codecs get the payload as str, binary ones as bytes.
+class JsonCodec:
+    text = True
+
+    def decode(self, payload):
+        return json.loads(payload)
+
+    def encode(self, data):
+        return json.dumps(data)
+
+
+class MsgpackCodec:
+    text = False
+
+    def decode(self, payload):
+        return msgpack.unpackb(payload, raw=False)
+
+    def encode(self, data):
+        return msgpack.packb(data, use_bin_type=True)
+
+
+class CborCodec:
+    text = False
+
+    def decode(self, payload):
+        return cbor2.loads(payload)
+
+    def encode(self, data):
+        return cbor2.dumps(data)
+
+
+# Detects the format from the first byte of a map payload, commands are
+# always sent as JSON
+class AutoCodec:
+    text = False
+
+    def decode(self, payload):
+        first = payload.lstrip()[:1]
+        if first in (b"{", b"["):
+            return json.loads(payload)
+        if msgpack is not None and (
+            b"\x80" <= first <= b"\x8f" or first in (b"\xde", b"\xdf")
+        ):
+            return MsgpackCodec().decode(payload)
+        if cbor2 is not None and (b"\xa0" <= first <= b"\xbb" or first == b"\xbf"):
+            return CborCodec().decode(payload)
+        return json.loads(payload)
+
+    def encode(self, data):
+        return json.dumps(data)
+
+
+CODECS = {"json": JsonCodec(), "auto": AutoCodec()}
+if msgpack is not None:
+    CODECS["msgpack"] = MsgpackCodec()
+if cbor2 is not None:
+    CODECS["cbor"] = CborCodec()
+
+# Shard worker record kinds: raw bytes, UTF-8 text, decoded structure,
+# dedup counts {topic: [skipped, total]} since the previous HITS record,
+# and the shard number once its subscriptions are sent
+RAW, TEXT, DECODED, HITS, SUBSCRIBED = 0, 1, 2, 3, 4
+HITS_INTERVAL = 10.0
+
+
+# Ingress dedup shared by the controller and the shard workers: byte-identical
+# repeats are skipped before decoding, but still let through every refresh
+# seconds. last_payload maps topic -> (payload, processed at) and hits maps
+# topic -> [skipped, total].
+def duplicate(last_payload, hits, refresh, topic, payload):
+    now = time.monotonic()
+    last = last_payload.get(topic)
+    counts = hits.get(topic)
+    if counts is None:
+        counts = hits.setdefault(topic, [0, 0])
+    counts[1] += 1
+    if last is not None and last[0] == payload and now - last[1] < refresh:
+        counts[0] += 1
+        return True
+    last_payload[topic] = (payload, now)
+    return False
+
+
+# Payload already decoded by a shard worker, see MQNode.decode
+class Decoded:
+    def __init__(self, data):
+        self.data = data
+
+    def __repr__(self):
+        return repr(self.data)
+
+
+# Runs in a separate process: MQTT ingest, dedup and payload decoding for one
+# shard of the status topics. topics maps status_topic to a codec name, or
+# None for plain text payloads. Records go to the controller through
+# out_queue, topics to forget the last payload of come in through resets.
+def shard_worker(shard, broker, topics, out_queue, resets, refresh):
+    subscribed = False
+    last_payload = {}
+    hits = {}
+    hits_sent = time.monotonic()
+
+    def on_connect(client, userdata, flags, rc):
+        nonlocal subscribed
+        if rc == 0:
+            if subscribed and flags.get("session present"):
+                return
+            client.subscribe([(topic, broker["qos"]) for topic in topics])
+            subscribed = True
+            out_queue.put((None, False, SUBSCRIBED, shard))
+        else:
+            LOGGER.error("Shard {} MQTT Connect failed".format(shard))
+
+    def on_message(client, userdata, message):
+        nonlocal hits, hits_sent
+        payload = message.payload
+        while not resets.empty():
+            try:
+                last_payload.pop(resets.get_nowait(), None)
+            except queue.Empty:
+                break
+        if refresh > 0:
+            if time.monotonic() - hits_sent > HITS_INTERVAL:
+                out_queue.put((None, False, HITS, hits))
+                hits = {}
+                hits_sent = time.monotonic()
+            if duplicate(last_payload, hits, refresh, message.topic, payload):
+                return
+        codec = topics.get(message.topic)
+        try:
+            if codec is None:
+                record = (TEXT, payload.decode("utf-8"))
+            elif CODECS[codec].text:
+                record = (DECODED, CODECS[codec].decode(payload.decode("utf-8")))
+            else:
+                record = (DECODED, CODECS[codec].decode(payload))
+        except Exception:
+            # Let the controller report it with the rest of the payload errors
+            record = (RAW, payload)
+        out_queue.put((message.topic, message.retain) + record)
+
+    if broker["client_id"]:
+        client = mqtt.Client(
+            client_id="{}-{}".format(broker["client_id"], shard), clean_session=False
+        )
+    else:
+        client = mqtt.Client()
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.username_pw_set(broker["user"], broker["password"])
+    # connect() would raise right away if the broker is down, connect_async()
+    # leaves the first attempt to loop_forever, which keeps retrying
+    client.connect_async(broker["server"], broker["port"], 10)
+    client.loop_forever(retry_first_connection=True)
+
+
+# Dedicated broker connection and thread for device commands, so a publish
+# never waits behind inbound message handling on the main client's loop
+class CommandLane:
+    def __init__(self, broker, fallback):
+        client_id = "{}-cmd".format(broker["client_id"]) if broker["client_id"] else ""
+        self.broker = broker
+        self.fallback = fallback
+        self.client = mqtt.Client(client_id=client_id)
+        self.client.username_pw_set(broker["user"], broker["password"])
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._sender, daemon=True)
+
+    def start(self):
+        self.client.connect(self.broker["server"], self.broker["port"], 10)
+        self.client.loop_start()
+        self.thread.start()
+
+    def stop(self):
+        self.queue.put(None)
+        self.client.loop_stop()
+        self.client.disconnect()
+
+    def publish(self, topic, message):
+        self.queue.put((topic, message))
+
+    def _sender(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            # Publishing from outside the network loop wakes it through
+            # paho's socket pair, so the packet is written right away
+            if self.client.is_connected():
+                self.client.publish(item[0], item[1], retain=False)
+            else:
+                self.fallback(item[0], item[1], retain=False)
+
+
+# Write-behind SQLite store for node telemetry: samples are buffered in
+# memory and written by a background thread in one transaction per batch
+class HistorySink:
+    def __init__(self, path, batch=500, interval=30.0, days=30):
+        self.path = path
+        self.batch = batch
+        self.interval = interval
+        self.days = days
+        self.buffer = deque(maxlen=batch * 10)
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.counters = {"written": 0, "dropped": 0}
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.wakeup.set()
+        self.thread.join(10)
+
+    def add(self, node, driver, value):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return
+        with self.lock:
+            if len(self.buffer) == self.buffer.maxlen:
+                self.counters["dropped"] += 1
+            self.buffer.append((time.time(), node, driver, value))
+            if len(self.buffer) >= self.batch:
+                self.wakeup.set()
+
+    def pending(self):
+        return len(self.buffer)
+
+    def _writer(self):
+        try:
+            db = sqlite3.connect(self.path)
+            db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            db.execute("PRAGMA journal_mode = WAL")
+            db.execute("PRAGMA synchronous = NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS samples "
+                "(ts REAL, node TEXT, driver TEXT, value REAL)"
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS samples_node "
+                "ON samples (node, driver, ts)"
+            )
+            db.commit()
+        except Exception as ex:
+            LOGGER.error("Failed to open history {}: {}".format(self.path, ex))
+            return
+        compacted = None
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            with self.lock:
+                samples = list(self.buffer)
+                self.buffer.clear()
+            try:
+                if samples:
+                    with db:
+                        db.executemany(
+                            "INSERT INTO samples VALUES (?, ?, ?, ?)", samples
+                        )
+                    self.counters["written"] += len(samples)
+                if compacted is None or time.monotonic() - compacted > 3600:
+                    compacted = time.monotonic()
+                    with db:
+                        db.execute(
+                            "DELETE FROM samples WHERE ts < ?",
+                            (time.time() - self.days * 86400,),
+                        )
+                    # A single execute() only steps the pragma once and
+                    # frees one page, executescript() runs it to completion
+                    db.executescript("PRAGMA incremental_vacuum")
+            except Exception as ex:
+                LOGGER.error("Failed to write history: {}".format(ex))
+            if self.stopping.is_set():
+                break
+        db.close()
+
 
 class Controller(polyinterface.Controller):
     def __init__(self, polyglot):
@@ -20,10 +323,61 @@ class Controller(polyinterface.Controller):
         self.mqtt_port = 1883
         self.mqtt_user = None
         self.mqtt_password = None
+        # Persistent session with QoS 1 subscriptions when client_id is set
+        self.client_id = None
+        self.qos = 0
+        self.session_ready = False
         self.devlist = None
         # example: [ {'id': 'sonoff1', 'type': 'switch', 'status_topic': 'stat/sonoff1/power', 'cmd_topic': 'cmnd/sonoff1/power'} ]
         self.status_topics = []
         self.mqttc = None
+        # example: {1: {'id': 'downstairs', 'cmd_topic': 'cmnd/sonoffs/POWER', 'members': ['sonoff1', 'sonoff2']}}
+        self.groups = {}
+        # status_topic -> node address, cmd_topic -> status_topic (None if shared)
+        self.topic_nodes = {}
+        self.node_topics = {}
+        self.cmd_status = {}
+        self.cmd_timeout = 5.0
+        self.cmd_retries = 1
+        # status_topic -> {'topic', 'message', 'first', 'sent', 'retries', 'retry'}
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        # status_topic -> {'hist', 'count', 'total', 'retries', 'timeouts'}
+        self.rtt = {}
+        self.stopping = threading.Event()
+        # Outbound stage toward Polyglot: command/event reports and state
+        # drivers of controllable devices go first and are never dropped,
+        # telemetry drivers are coalesced per (node, driver) and bounded
+        self.out_size = 500
+        self.out_events = deque()
+        self.out_telemetry = OrderedDict()
+        self.out_cond = threading.Condition()
+        self.out_counters = {"events": 0, "drivers": 0, "coalesced": 0, "dropped": 0}
+        # Node class name (or 'Polyglot') -> [calls, seconds]
+        self.timings = {}
+        self.profile_dir = "profiles"
+        self.profiler = None
+        # (topic or node address, error class) -> [last logged, suppressed count]
+        self.errors = {}
+        self.error_interval = 60.0
+        # Status topics that delivered a retained message after subscribing
+        self.retained_wait = 2.0
+        self.retained = set()
+        self.seeding = False
+        # Optional shard worker processes doing MQTT ingest and decoding
+        self.workers = 0
+        self.shards = []
+        self.shard_args = []
+        # status_topic -> reset queue of the shard worker handling it
+        self.shard_resets = {}
+        self.shards_subscribed = set()
+        self.shard_queue = None
+        self.history = None
+        self.cmd_lane = None
+        # Ingress dedup: topic -> (last payload, processed at), [skipped, total]
+        self.dedup_refresh = 300.0
+        self.last_payload = {}
+        self.dedup_hits = {}
 
     def start(self):
         # LOGGER.setLevel(logging.INFO)
@@ -41,6 +395,27 @@ class Controller(polyinterface.Controller):
 
         self.mqtt_user = self.polyConfig["customParams"]["mqtt_user"]
         self.mqtt_password = self.polyConfig["customParams"]["mqtt_password"]
+        if self.polyConfig["customParams"].get("client_id"):
+            self.client_id = self.polyConfig["customParams"]["client_id"]
+            self.qos = 1
+        if "cmd_timeout" in self.polyConfig["customParams"]:
+            self.cmd_timeout = float(self.polyConfig["customParams"]["cmd_timeout"])
+        if "cmd_retries" in self.polyConfig["customParams"]:
+            self.cmd_retries = int(self.polyConfig["customParams"]["cmd_retries"])
+        if "out_queue" in self.polyConfig["customParams"]:
+            self.out_size = int(self.polyConfig["customParams"]["out_queue"])
+        if "profile_dir" in self.polyConfig["customParams"]:
+            self.profile_dir = self.polyConfig["customParams"]["profile_dir"]
+        if "dedup_refresh" in self.polyConfig["customParams"]:
+            self.dedup_refresh = float(self.polyConfig["customParams"]["dedup_refresh"])
+        if "workers" in self.polyConfig["customParams"]:
+            self.workers = int(self.polyConfig["customParams"]["workers"])
+        if "retained_wait" in self.polyConfig["customParams"]:
+            self.retained_wait = float(self.polyConfig["customParams"]["retained_wait"])
+        if "error_interval" in self.polyConfig["customParams"]:
+            self.error_interval = float(
+                self.polyConfig["customParams"]["error_interval"]
+            )
 
         if "devfile" in self.polyConfig["customParams"]:
             try:
@@ -71,6 +446,7 @@ class Controller(polyinterface.Controller):
                 )
                 return False
             self.devlist = data["devices"]
+            groups = data.get("groups", [])
 
         elif "devlist" in self.polyConfig["customParams"]:
             try:
@@ -78,15 +454,28 @@ class Controller(polyinterface.Controller):
             except Exception as ex:
                 LOGGER.error("Failed to parse the devlist: {}".format(ex))
                 return False
+            groups = []
+            if "grouplist" in self.polyConfig["customParams"]:
+                try:
+                    groups = json.loads(self.polyConfig["customParams"]["grouplist"])
+                except Exception as ex:
+                    LOGGER.error("Failed to parse the grouplist: {}".format(ex))
         else:
             LOGGER.error("devlist must be configured")
             return False
 
-        self.mqttc = mqtt.Client()
+        if self.client_id:
+            self.mqttc = mqtt.Client(client_id=self.client_id, clean_session=False)
+        else:
+            self.mqttc = mqtt.Client()
         self.mqttc.on_connect = self._on_connect
         self.mqttc.on_disconnect = self._on_disconnect
         self.mqttc.on_message = self._on_message
         self.mqttc.is_connected = False
+        if self.polyConfig["customParams"].get("cmd_lane", "0") not in ("0", ""):
+            self.cmd_lane = CommandLane(self._broker(), self.mqttc.publish)
+        if self.out_size > 0:
+            threading.Thread(target=self._out_worker, daemon=True).start()
 
         for dev in self.devlist:
             if (
@@ -164,24 +553,174 @@ class Controller(polyinterface.Controller):
                     self.status_topics.append(dev["status_topic"])
             else:
                 LOGGER.error("Device type {} is not yet supported".format(dev["type"]))
+                continue
+            self.topic_nodes[dev["status_topic"]] = address
+            self.node_topics[address] = dev["status_topic"]
+            if dev["cmd_topic"] in self.cmd_status:
+                # Generic cmd_topic shared by several devices, can't correlate
+                self.cmd_status[dev["cmd_topic"]] = None
+            else:
+                self.cmd_status[dev["cmd_topic"]] = dev["status_topic"]
+        self._load_groups(groups)
+        if self.polyConfig["customParams"].get("history_db"):
+            self.history = HistorySink(
+                self.polyConfig["customParams"]["history_db"],
+                int(self.polyConfig["customParams"].get("history_batch", 500)),
+                float(self.polyConfig["customParams"].get("history_interval", 30)),
+                int(self.polyConfig["customParams"].get("history_days", 30)),
+            )
+            self.history.start()
+        if self.workers > 0:
+            self._start_shards()
         LOGGER.info("Done adding nodes, connecting to MQTT broker...")
         self.mqttc.username_pw_set(self.mqtt_user, self.mqtt_password)
         try:
             self.mqttc.connect(self.mqtt_server, self.mqtt_port, 10)
             self.mqttc.loop_start()
+            if self.cmd_lane is not None:
+                self.cmd_lane.start()
         except Exception as ex:
             LOGGER.error("Error connecting to Poly MQTT broker {}".format(ex))
             return False
+        if self.cmd_timeout > 0:
+            threading.Thread(target=self._watchdog, daemon=True).start()
 
         return True
 
+    def _start_shards(self):
+        # Status topics are dealt round-robin to the workers, this process
+        # keeps the node state and stays the only one talking to Polyglot
+        if self.workers > len(self.status_topics):
+            # An empty shard would send a SUBSCRIBE without topics, which
+            # the broker answers by closing the connection
+            LOGGER.warning(
+                "Only {} status topics, starting {} shard workers instead of {}".format(
+                    len(self.status_topics), len(self.status_topics), self.workers
+                )
+            )
+            self.workers = len(self.status_topics)
+            if self.workers == 0:
+                return
+        topics = [{} for i in range(self.workers)]
+        for i, stopic in enumerate(self.status_topics):
+            node = self.nodes[self.topic_nodes[stopic]]
+            codec = node.codec_name if node.structured else None
+            topics[i % self.workers][stopic] = codec
+        broker = self._broker()
+        ctx = multiprocessing.get_context("spawn")
+        self.shard_queue = ctx.Queue(10000)
+        for shard in range(self.workers):
+            LOGGER.info(
+                "Starting shard worker {} for {} topics".format(
+                    shard, len(topics[shard])
+                )
+            )
+            resets = ctx.Queue()
+            for stopic in topics[shard]:
+                self.shard_resets[stopic] = resets
+            self.shard_args.append(
+                (
+                    shard,
+                    broker,
+                    topics[shard],
+                    self.shard_queue,
+                    resets,
+                    self.dedup_refresh,
+                )
+            )
+            self.shards.append(self._spawn_shard(shard))
+        self.status_topics = []
+        threading.Thread(target=self._shard_reader, daemon=True).start()
+
+    def _spawn_shard(self, shard):
+        ctx = multiprocessing.get_context("spawn")
+        proc = ctx.Process(
+            target=shard_worker, args=self.shard_args[shard], daemon=True
+        )
+        proc.start()
+        return proc
+
+    def _check_shards(self):
+        for shard, proc in enumerate(self.shards):
+            if proc.is_alive() or self.stopping.is_set():
+                continue
+            LOGGER.error(
+                "Shard worker {} exited with code {}, restarting".format(
+                    shard, proc.exitcode
+                )
+            )
+            self.shards[shard] = self._spawn_shard(shard)
+
+    def _broker(self):
+        return {
+            "server": self.mqtt_server,
+            "port": self.mqtt_port,
+            "user": self.mqtt_user,
+            "password": self.mqtt_password,
+            "client_id": self.client_id,
+            "qos": self.qos,
+        }
+
+    def _shard_reader(self):
+        while not self.stopping.is_set():
+            try:
+                topic, retain, kind, payload = self.shard_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            if kind == SUBSCRIBED:
+                # Seed once every worker has subscribed for the first time
+                if len(self.shards_subscribed) < self.workers:
+                    self.shards_subscribed.add(payload)
+                    if len(self.shards_subscribed) == self.workers:
+                        self._seed()
+                continue
+            if kind == HITS:
+                for hit_topic, (skipped, total) in payload.items():
+                    counts = self.dedup_hits.setdefault(hit_topic, [0, 0])
+                    counts[0] += skipped
+                    counts[1] += total
+                continue
+            if kind == DECODED:
+                payload = Decoded(payload)
+            self._process(topic, retain, payload, deduped=True)
+
+    def _load_groups(self, groups):
+        # Groups are numbered by their position in the list, starting from 1
+        for num, grp in enumerate(groups, start=1):
+            if "id" not in grp or "cmd_topic" not in grp or "devices" not in grp:
+                LOGGER.error("Invalid group definition: {}".format(json.dumps(grp)))
+                continue
+            members = []
+            for dev_id in grp["devices"]:
+                address = dev_id.lower().replace("_", "")[:14]
+                if address in self.nodes and isinstance(self.nodes[address], MQSwitch):
+                    members.append(address)
+                else:
+                    LOGGER.error(
+                        "Group {} member {} is not a switch".format(grp["id"], dev_id)
+                    )
+            LOGGER.info(
+                "Adding group {} {} with {} members".format(num, grp["id"], len(members))
+            )
+            self.groups[num] = {
+                "id": grp["id"],
+                "cmd_topic": grp["cmd_topic"],
+                "members": members,
+            }
+
     def _on_connect(self, mqttc, userdata, flags, rc):
         if rc == 0:
-            LOGGER.info("Poly MQTT Connected, subscribing...")
             self.mqttc.is_connected = True
+            if self.session_ready and flags.get("session present"):
+                # Broker kept our subscriptions and queued what we missed
+                LOGGER.info("Poly MQTT Connected, resuming persistent session")
+                return
+            LOGGER.info("Poly MQTT Connected, subscribing...")
             results = []
             for stopic in self.status_topics:
-                results.append((stopic, tuple(self.mqttc.subscribe(stopic))))
+                results.append(
+                    (stopic, tuple(self.mqttc.subscribe(stopic, qos=self.qos)))
+                )
             for (topic, (result, mid)) in results:
                 if result == 0:
                     LOGGER.info(
@@ -193,11 +732,40 @@ class Controller(polyinterface.Controller):
                             topic, mid, result
                         )
                     )
+            self.session_ready = self.client_id is not None
+            # With workers the status topics are theirs, see _shard_reader
+            if not self.shards:
+                self._seed()
+        else:
+            LOGGER.error("Poly MQTT Connect failed")
+
+    def _seed(self):
+        if self.retained_wait > 0:
+            # Let the broker deliver retained state first, then only
+            # query the devices that had none
+            self.retained = set()
+            self.seeding = True
+            timer = threading.Timer(self.retained_wait, self._query_unseeded)
+            timer.daemon = True
+            timer.start()
+        else:
             for node in self.nodes:
                 if self.nodes[node].address != self.address:
                     self.nodes[node].query()
-        else:
-            LOGGER.error("Poly MQTT Connect failed")
+
+    def _query_unseeded(self):
+        self.seeding = False
+        # The message thread may still be adding to the set
+        retained, self.retained = self.retained, set()
+        seeded = set(self.topic_nodes.get(topic) for topic in retained)
+        LOGGER.info(
+            "{} nodes seeded from retained messages, querying the rest".format(
+                len(seeded)
+            )
+        )
+        for node in self.nodes:
+            if self.nodes[node].address != self.address and node not in seeded:
+                self.nodes[node].query()
 
     def _on_disconnect(self, mqttc, userdata, rc):
         self.mqttc.is_connected = False
@@ -212,24 +780,352 @@ class Controller(polyinterface.Controller):
             LOGGER.info("Poly MQTT graceful disconnection")
 
     def _on_message(self, mqttc, userdata, message):
-        topic = message.topic
-        payload = message.payload.decode("utf-8")
-        LOGGER.debug("Received {} from {}".format(payload, topic))
+        self._process(message.topic, message.retain, message.payload)
+
+    def _process(self, topic, retain, payload, deduped=False):
+        # deduped: the shard worker already ran the check on the raw bytes
+        if self.seeding and retain:
+            self.retained.add(topic)
+        if self.pending:
+            self._cmd_done(topic)
+        if (
+            self.dedup_refresh > 0
+            and not deduped
+            and isinstance(payload, bytes)
+            and self._duplicate(topic, payload)
+        ):
+            return
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.enable()
+        LOGGER.debug("Received %s from %s", payload, topic)
         try:
-            self.nodes[self._dev_by_topic(topic)].updateInfo(payload)
+            node = self.nodes[self._dev_by_topic(topic)]
+            if isinstance(payload, bytes) and node.codec.text:
+                payload = payload.decode("utf-8")
+            started = time.perf_counter()
+            node.updateInfo(payload)
+            self._timing(type(node).__name__, time.perf_counter() - started)
         except Exception as ex:
-            LOGGER.error("Failed to process message {}".format(ex))
+            self.log_error(
+                (topic, type(ex).__name__), "Failed to process message {}", ex
+            )
+        if profiler is not None:
+            profiler.disable()
+
+    def _duplicate(self, topic, payload):
+        return duplicate(
+            self.last_payload, self.dedup_hits, self.dedup_refresh, topic, payload
+        )
+
+    def _dedup_reset(self, topic):
+        # Let the next message on topic through, also in the shard owning it
+        self.last_payload.pop(topic, None)
+        resets = self.shard_resets.get(topic)
+        if resets is not None:
+            resets.put(topic)
+
+    def log_error(self, key, fmt, *args):
+        # First occurrence per key is logged, repeats within error_interval
+        # are only counted and never formatted
+        now = time.monotonic()
+        entry = self.errors.get(key)
+        if entry is not None and now - entry[0] < self.error_interval:
+            entry[1] += 1
+            return
+        self.errors[key] = [now, 0]
+        if entry is not None and entry[1] > 0:
+            LOGGER.error(fmt.format(*args) + " ({} more suppressed)".format(entry[1]))
+        else:
+            LOGGER.error(fmt.format(*args))
+
+    def _flush_errors(self):
+        for (source, error), entry in list(self.errors.items()):
+            if entry[1] > 0:
+                LOGGER.error(
+                    "{} {}: {} more suppressed".format(source, error, entry[1])
+                )
+                entry[1] = 0
+
+    def _timing(self, name, elapsed):
+        timing = self.timings.get(name)
+        if timing is None:
+            timing = self.timings.setdefault(name, [0, 0.0])
+        timing[0] += 1
+        timing[1] += elapsed
 
     def _dev_by_topic(self, topic):
-        for dev in self.devlist:
-            if dev["status_topic"] == topic:
-                return dev["id"].lower()[:14]
-        return None
+        return self.topic_nodes.get(topic)
+
+    def mqtt_pub(self, topic, message, retry=True):
+        # retry=False for relative commands that must not be sent twice
+        self._publish(topic, message)
+        # Always process the device's answer, even if it repeats the last one
+        if self.cmd_status.get(topic) is not None:
+            self._dedup_reset(self.cmd_status[topic])
+        if self.cmd_timeout > 0 and self.cmd_status.get(topic) is not None:
+            self._cmd_sent(self.cmd_status[topic], topic, message, retry)
+
+    def _publish(self, topic, message):
+        if self.cmd_lane is not None:
+            self.cmd_lane.publish(topic, message)
+        else:
+            self.mqttc.publish(topic, message, retain=False)
+
+    def _cmd_sent(self, status_topic, topic, message, retry=True):
+        now = time.monotonic()
+        with self.pending_lock:
+            self.pending[status_topic] = {
+                "topic": topic,
+                "message": message,
+                "first": now,
+                "sent": now,
+                "retries": 0,
+                "retry": retry,
+            }
+
+    def _cmd_done(self, status_topic):
+        with self.pending_lock:
+            cmd = self.pending.pop(status_topic, None)
+            if cmd is None:
+                return
+            elapsed = (time.monotonic() - cmd["first"]) * 1000
+            stats = self._rtt_stats(status_topic)
+            stats["count"] += 1
+            stats["total"] += elapsed
+            for i, bound in enumerate(RTT_BUCKETS):
+                if elapsed <= bound:
+                    stats["hist"][i] += 1
+                    break
+            else:
+                stats["hist"][-1] += 1
+
+    def _rtt_stats(self, status_topic):
+        if status_topic not in self.rtt:
+            self.rtt[status_topic] = {
+                "hist": [0] * (len(RTT_BUCKETS) + 1),
+                "count": 0,
+                "total": 0.0,
+                "retries": 0,
+                "timeouts": 0,
+            }
+        return self.rtt[status_topic]
+
+    def _watchdog(self):
+        while not self.stopping.wait(1):
+            self._check_pending()
+
+    def _check_pending(self):
+        now = time.monotonic()
+        resend = []
+        resync = []
+        with self.pending_lock:
+            for status_topic, cmd in list(self.pending.items()):
+                if now - cmd["sent"] < self.cmd_timeout:
+                    continue
+                stats = self._rtt_stats(status_topic)
+                if cmd["retry"] and cmd["retries"] < self.cmd_retries:
+                    cmd["retries"] += 1
+                    cmd["sent"] = now
+                    stats["retries"] += 1
+                    resend.append((cmd["topic"], cmd["message"]))
+                else:
+                    del self.pending[status_topic]
+                    stats["timeouts"] += 1
+                    resync.append(status_topic)
+                    LOGGER.warning(
+                        "No response from {} to {} {} after {} retries".format(
+                            self.topic_nodes.get(status_topic),
+                            cmd["topic"],
+                            cmd["message"],
+                            cmd["retries"],
+                        )
+                    )
+        for (topic, message) in resend:
+            LOGGER.info("Retrying {} {}".format(topic, message))
+            self._publish(topic, message)
+        for status_topic in resync:
+            # The node already shows the state the command asked for, query
+            # the device once to bring it back in line
+            node = self.nodes.get(self.topic_nodes.get(status_topic))
+            if node is not None:
+                node.query()
+                with self.pending_lock:
+                    self.pending.pop(status_topic, None)
+
+    def queue_driver(self, node, driver, value, report=True, force=False, uom=None):
+        if self.out_size <= 0:
+            polyinterface.Node.setDriver(node, driver, value, report, force, uom)
+            return
+        update = (node, driver, value, report, force, uom)
+        if not node.telemetry:
+            # Switch, fan, flag etc. state must reach the ISY, and dropping it
+            # would also let ingress dedup skip the next identical status
+            with self.out_cond:
+                self.out_events.append((polyinterface.Node.setDriver, update))
+                self.out_cond.notify()
+            return
+        key = (node.address, driver)
+        with self.out_cond:
+            if key in self.out_telemetry:
+                self.out_counters["coalesced"] += 1
+            elif len(self.out_telemetry) >= self.out_size:
+                dropped = self.out_telemetry.popitem(last=False)[1][0]
+                self.out_counters["dropped"] += 1
+                # Let the next copy of the dropped status through
+                self._dedup_reset(self.node_topics.get(dropped.address))
+            self.out_telemetry[key] = update
+            self.out_cond.notify()
+
+    def queue_cmd(self, node, command, value=None, uom=None):
+        if self.out_size <= 0:
+            polyinterface.Node.reportCmd(node, command, value, uom)
+            return
+        with self.out_cond:
+            self.out_events.append(
+                (polyinterface.Node.reportCmd, (node, command, value, uom))
+            )
+            self.out_cond.notify()
+
+    def _out_worker(self):
+        while not self.stopping.is_set():
+            event = update = None
+            with self.out_cond:
+                if not self.out_events and not self.out_telemetry:
+                    self.out_cond.wait(1)
+                if self.out_events:
+                    event = self.out_events.popleft()
+                elif self.out_telemetry:
+                    update = self.out_telemetry.popitem(last=False)[1]
+            try:
+                started = time.perf_counter()
+                if event is not None:
+                    event[0](*event[1])
+                    if event[0] is polyinterface.Node.setDriver:
+                        self.out_counters["drivers"] += 1
+                    else:
+                        self.out_counters["events"] += 1
+                elif update is not None:
+                    polyinterface.Node.setDriver(*update)
+                    self.out_counters["drivers"] += 1
+                else:
+                    continue
+                self._timing("Polyglot", time.perf_counter() - started)
+            except Exception as ex:
+                LOGGER.error("Failed to send update to Polyglot: {}".format(ex))
+
+    def _log_stats(self, full=False):
+        # Periodic calls log totals and only the devices with new retries or
+        # timeouts, the per-device/topic/class details need full=True
+        count = elapsed = retries = timeouts = 0
+        for status_topic, stats in list(self.rtt.items()):
+            count += stats["count"]
+            elapsed += stats["total"]
+            retries += stats["retries"]
+            timeouts += stats["timeouts"]
+            problems = (stats["retries"], stats["timeouts"])
+            if not full and stats.get("reported", (0, 0)) == problems:
+                continue
+            stats["reported"] = problems
+            hist = " ".join(
+                "<={}:{}".format(bound, n)
+                for bound, n in zip(RTT_BUCKETS + ["inf"], stats["hist"])
+            )
+            LOGGER.info(
+                "RTT {}: n={} avg={:.0f}ms retries={} timeouts={} [{}]".format(
+                    self.topic_nodes.get(status_topic),
+                    stats["count"],
+                    stats["total"] / stats["count"] if stats["count"] else 0,
+                    stats["retries"],
+                    stats["timeouts"],
+                    hist,
+                )
+            )
+        if self.rtt:
+            LOGGER.info(
+                "RTT total: n={} avg={:.0f}ms retries={} timeouts={}".format(
+                    count, elapsed / count if count else 0, retries, timeouts
+                )
+            )
+        LOGGER.info(
+            "Polyglot queue: events={} drivers={} coalesced={} dropped={} pending={}".format(
+                self.out_counters["events"],
+                self.out_counters["drivers"],
+                self.out_counters["coalesced"],
+                self.out_counters["dropped"],
+                len(self.out_events) + len(self.out_telemetry),
+            )
+        )
+        if self.history is not None:
+            LOGGER.info(
+                "History: written={} dropped={} pending={}".format(
+                    self.history.counters["written"],
+                    self.history.counters["dropped"],
+                    self.history.pending(),
+                )
+            )
+        skipped = total = 0
+        for topic, (hits, seen) in sorted(list(self.dedup_hits.items())):
+            skipped += hits
+            total += seen
+            if full and hits:
+                LOGGER.info(
+                    "Dedup {}: skipped={} of {} ({:.0f}%)".format(
+                        topic, hits, seen, hits * 100.0 / seen
+                    )
+                )
+        if total:
+            LOGGER.info(
+                "Dedup total: skipped={} of {} ({:.0f}%)".format(
+                    skipped, total, skipped * 100.0 / total
+                )
+            )
+        if not full:
+            return
+        for name, (calls, total) in sorted(self.timings.items()):
+            LOGGER.info(
+                "Timing {}: calls={} total={:.3f}s avg={:.0f}us".format(
+                    name, calls, total, total / calls * 1000000
+                )
+            )
 
-    def mqtt_pub(self, topic, message):
-        self.mqttc.publish(topic, message, retain=False)
+    def _profile_start(self, duration):
+        if self.profiler is not None:
+            LOGGER.warning("Profiling is already running")
+            return
+        LOGGER.info("Profiling message handling for {}s".format(duration))
+        tracemalloc.start()
+        self.profiler = cProfile.Profile()
+        timer = threading.Timer(duration, self._profile_stop)
+        timer.daemon = True
+        timer.start()
+
+    def _profile_stop(self):
+        profiler, self.profiler = self.profiler, None
+        if profiler is None:
+            return
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        base = os.path.join(self.profile_dir, time.strftime("mqtt-%Y%m%d-%H%M%S"))
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            profiler.dump_stats(base + ".prof")
+            with open(base + "-alloc.txt", "w") as f:
+                for stat in snapshot.statistics("lineno")[:50]:
+                    f.write("{}\n".format(stat))
+        except Exception as ex:
+            LOGGER.error("Failed to write profile {}: {}".format(base, ex))
+            return
+        LOGGER.info("Profile written to {}.prof and {}-alloc.txt".format(base, base))
 
     def stop(self):
+        self.stopping.set()
+        if self.history is not None:
+            self.history.stop()
+        if self.cmd_lane is not None:
+            self.cmd_lane.stop()
+        for proc in self.shards:
+            proc.terminate()
         self.mqttc.loop_stop()
         self.mqttc.disconnect()
         LOGGER.info("MQTT is stopping")
@@ -237,6 +1133,11 @@ class Controller(polyinterface.Controller):
     def updateInfo(self):
         pass
 
+    def longPoll(self):
+        self._check_shards()
+        self._flush_errors()
+        self._log_stats()
+
     def query(self, command=None):
         for node in self.nodes:
             self.nodes[node].reportDrivers()
@@ -244,15 +1145,106 @@ class Controller(polyinterface.Controller):
     def discover(self, command=None):
         pass
 
+    def stats(self, command=None):
+        self._log_stats(full=True)
+
+    def profile(self, command):
+        try:
+            duration = int(command.get("value"))
+        except Exception as ex:
+            LOGGER.info("Unexpected profiling duration {}, assuming 60s".format(ex))
+            duration = 60
+        if duration <= 0:
+            duration = 60
+        self._profile_start(duration)
+
+    def group_on(self, command):
+        self._group_set(command, "ON")
+
+    def group_off(self, command):
+        self._group_set(command, "OFF")
+
+    def _group_set(self, command, payload):
+        try:
+            num = int(command.get("value"))
+        except Exception as ex:
+            LOGGER.error("Invalid group number: {}".format(ex))
+            return
+        if num not in self.groups:
+            LOGGER.error("Group {} is not configured".format(num))
+            return
+        group = self.groups[num]
+        # Single publish to the Tasmota GroupTopic, members are updated
+        # optimistically and corrected by their own stat/.../POWER echoes
+        self.mqtt_pub(group["cmd_topic"], payload)
+        for address in group["members"]:
+            node = self.nodes[address]
+            node.set_state(payload == "ON")
+            self._dedup_reset(node.status_topic)
+            # Missing echoes are retried against the member's own topic
+            if self.cmd_timeout > 0 and self.cmd_status.get(node.cmd_topic):
+                self._cmd_sent(node.status_topic, node.cmd_topic, payload)
+
     id = "MQCTRL"
-    commands = {"DISCOVER": discover}
+    commands = {
+        "DISCOVER": discover,
+        "STATS": stats,
+        "PROFILE": profile,
+        "GRPON": group_on,
+        "GRPOFF": group_off,
+    }
     drivers = [{"driver": "ST", "value": 1, "uom": 2}]
 
 
-class MQSwitch(polyinterface.Node):
-    def __init__(self, controller, primary, address, name, device):
+# Device nodes hand their status updates to the controller, which delivers
+# them to Polyglot in priority order
+class MQNode(polyinterface.Node):
+    # Devices with plain text payloads set this to False and ignore "codec"
+    structured = True
+    # Telemetry devices set this to have their drivers recorded when
+    # history_db is configured
+    history = False
+    # Read-only devices set this, their driver updates are coalesced and
+    # may be dropped when the Polyglot queue is full
+    telemetry = False
+
+    def __init__(self, controller, primary, address, name, device=None):
         super().__init__(controller, primary, address, name)
+        codec = "json"
+        if device is not None and self.structured:
+            codec = device.get("codec", "json")
+        if codec not in CODECS:
+            LOGGER.error(
+                "Codec {} is not available for {}, using json".format(codec, name)
+            )
+            codec = "json"
+        self.codec_name = codec
+        self.codec = CODECS[codec]
+
+    def decode(self, payload):
+        if isinstance(payload, Decoded):
+            return payload.data
+        return self.codec.decode(payload)
+
+    def setDriver(self, driver, value, report=True, force=False, uom=None):
+        if self.history and self.controller.history is not None:
+            self.controller.history.add(self.address, driver, value)
+        self.controller.queue_driver(self, driver, value, report, force, uom)
+
+    def reportCmd(self, command, value=None, uom=None):
+        self.controller.queue_cmd(self, command, value, uom)
+
+    def log_error(self, error, fmt, *args):
+        self.controller.log_error((self.address, error), fmt, *args)
+
+
+class MQSwitch(MQNode):
+    structured = False
+
+    def __init__(self, controller, primary, address, name, device):
+        super().__init__(controller, primary, address, name, device)
         self.cmd_topic = device["cmd_topic"]
+        self.status_topic = device["status_topic"]
         self.on = False
 
     def start(self):
@@ -270,7 +1262,7 @@ class MQSwitch(polyinterface.Node):
                 self.on = False
             self.setDriver("ST", 0)
         else:
-            LOGGER.error("Invalid payload {}".format(payload))
+            self.log_error("InvalidPayload", "Invalid payload {}", payload)
 
     def set_on(self, command):
         self.on = True
@@ -280,6 +1272,10 @@ class MQSwitch(polyinterface.Node):
         self.on = False
         self.controller.mqtt_pub(self.cmd_topic, "OFF")
 
+    def set_state(self, on):
+        self.on = on
+        self.setDriver("ST", 100 if on else 0)
+
     def query(self, command=None):
         self.controller.mqtt_pub(self.cmd_topic, "")
         self.reportDrivers()
@@ -291,9 +1287,9 @@ class MQSwitch(polyinterface.Node):
     commands = {"QUERY": query, "DON": set_on, "DOF": set_off}
 
 
-class MQFan(polyinterface.Node):
+class MQFan(MQNode):
     def __init__(self, controller, primary, address, name, device):
-        super().__init__(controller, primary, address, name)
+        super().__init__(controller, primary, address, name, device)
         self.cmd_topic = device["cmd_topic"]
         self.fan_speed = 0
 
@@ -302,12 +1298,15 @@ class MQFan(polyinterface.Node):
 
     def updateInfo(self, payload):
         try:
-            json_payload = json.loads(payload)
+            json_payload = self.decode(payload)
             fan_speed = int(json_payload['FanSpeed'])
         except Exception as ex:
-            LOGGER.error(f"Could not decode payload {payload}: {ex}")
+            self.log_error(
+                type(ex).__name__, "Could not decode payload {}: {}", payload, ex
+            )
+            return
         if 4 < fan_speed < 0:
-            LOGGER.error(f"Unexpected Fan Speed {fan_speed}")
+            self.log_error("FanSpeed", "Unexpected Fan Speed {}", fan_speed)
             return
         if self.fan_speed == 0 and fan_speed > 0:
             self.reportCmd("DON")
@@ -349,10 +1348,10 @@ class MQFan(polyinterface.Node):
         self.controller.mqtt_pub(self.cmd_topic, self.fan_speed)
         
     def speed_up(self, command):
-        self.controller.mqtt_pub(self.cmd_topic, "+")
+        self.controller.mqtt_pub(self.cmd_topic, "+", retry=False)
 
     def speed_down(self, command):
-        self.controller.mqtt_pub(self.cmd_topic, "-")
+        self.controller.mqtt_pub(self.cmd_topic, "-", retry=False)
 
     def query(self, command=None):
         self.controller.mqtt_pub(self.cmd_topic, "")
@@ -365,9 +1364,12 @@ class MQFan(polyinterface.Node):
     commands = {"QUERY": query, "DON": set_on, "DOF": set_off, "FDUP": speed_up, "FDDOWN": speed_down}
 
 
-class MQSensor(polyinterface.Node):
+class MQSensor(MQNode):
+    history = True
+    telemetry = True
+
     def __init__(self, controller, primary, address, name, device):
-        super().__init__(controller, primary, address, name)
+        super().__init__(controller, primary, address, name, device)
         self.cmd_topic = device["cmd_topic"]
         self.on = False
         self.motion = False
@@ -377,10 +1379,13 @@ class MQSensor(polyinterface.Node):
 
     def updateInfo(self, payload):
         try:
-            data = json.loads(payload)
+            data = self.decode(payload)
         except Exception as ex:
-            LOGGER.error(
-                "Failed to parse MQTT Payload as Json: {} {}".format(ex, payload)
+            self.log_error(
+                type(ex).__name__,
+                "Failed to parse MQTT Payload as Json: {} {}",
+                ex,
+                payload,
             )
             return False
 
@@ -428,10 +1433,10 @@ class MQSensor(polyinterface.Node):
                     self.setDriver("GV4", data["color"]["b"])
 
     def led_on(self, command):
-        self.controller.mqtt_pub(self.cmd_topic, json.dumps({"state": "ON"}))
+        self.controller.mqtt_pub(self.cmd_topic, self.codec.encode({"state": "ON"}))
 
     def led_off(self, command):
-        self.controller.mqtt_pub(self.cmd_topic, json.dumps({"state": "OFF"}))
+        self.controller.mqtt_pub(self.cmd_topic, self.codec.encode({"state": "OFF"}))
 
     def led_set(self, command):
         query = command.get("query")
@@ -451,7 +1456,7 @@ class MQSensor(polyinterface.Node):
         if flash > 0:
             cmd["flash"] = flash
 
-        self.controller.mqtt_pub(self.cmd_topic, json.dumps(cmd))
+        self.controller.mqtt_pub(self.cmd_topic, self.codec.encode(cmd))
 
     def _check_limit(self, value):
         if value > 255:
@@ -501,9 +1506,11 @@ class MQSensor(polyinterface.Node):
     # example condition: IOT devices sensor connections {OK, NOK, ERR(OR)}
 
 
-class MQFlag(polyinterface.Node):
+class MQFlag(MQNode):
+    structured = False
+
     def __init__(self, controller, primary, address, name, device):
-        super().__init__(controller, primary, address, name)
+        super().__init__(controller, primary, address, name, device)
         self.cmd_topic = device["cmd_topic"]
 
     def start(self):
@@ -535,7 +1542,7 @@ class MQFlag(polyinterface.Node):
         elif payload == "---":
             self.setDriver("ST", 12)
         else:
-            LOGGER.error("Invalid payload {}".format(payload))
+            self.log_error("InvalidPayload", "Invalid payload {}", payload)
             payload = "ERR"
             self.setDriver("ST", 4)
 
@@ -558,9 +1565,12 @@ class MQFlag(polyinterface.Node):
 # any of the following, since they I believe they get identified by tomaso the same:
 # DHT21, AM2301, AM2302, AM2321
 # Should be easy to add other temp/humdity sensors.
-class MQdht(polyinterface.Node):
+class MQdht(MQNode):
+    history = True
+    telemetry = True
+
     def __init__(self, controller, primary, address, name, device):
-        super().__init__(controller, primary, address, name)
+        super().__init__(controller, primary, address, name, device)
         self.on = False
 
     def start(self):
@@ -568,10 +1578,13 @@ class MQdht(polyinterface.Node):
 
     def updateInfo(self, payload):
         try:
-            data = json.loads(payload)
+            data = self.decode(payload)
         except Exception as ex:
-            LOGGER.error(
-                "Failed to parse MQTT Payload as Json: {} {}".format(ex, payload)
+            self.log_error(
+                type(ex).__name__,
+                "Failed to parse MQTT Payload as Json: {} {}",
+                ex,
+                payload,
             )
             return False
         if "AM2301" in data:
@@ -597,9 +1610,12 @@ class MQdht(polyinterface.Node):
 
 # This class is an attempt to add support for temperature only sensors.
 # was made for DS18B20 waterproof
-class MQds(polyinterface.Node):
+class MQds(MQNode):
+    history = True
+    telemetry = True
+
     def __init__(self, controller, primary, address, name, device):
-        super().__init__(controller, primary, address, name)
+        super().__init__(controller, primary, address, name, device)
         self.on = False
 
     def start(self):
@@ -607,10 +1623,13 @@ class MQds(polyinterface.Node):
 
     def updateInfo(self, payload):
         try:
-            data = json.loads(payload)
+            data = self.decode(payload)
         except Exception as ex:
-            LOGGER.error(
-                "Failed to parse MQTT Payload as Json: {} {}".format(ex, payload)
+            self.log_error(
+                type(ex).__name__,
+                "Failed to parse MQTT Payload as Json: {} {}",
+                ex,
+                payload,
             )
             return False
         if "DS18B20" in data:
@@ -634,9 +1653,12 @@ class MQds(polyinterface.Node):
 
 # This class is an attempt to add support for temperature/humidity/pressure sensors.
 # Currently supports the BME280.  Could be extended to accept others.
-class MQbme(polyinterface.Node):
+class MQbme(MQNode):
+    history = True
+    telemetry = True
+
     def __init__(self, controller, primary, address, name, device):
-        super().__init__(controller, primary, address, name)
+        super().__init__(controller, primary, address, name, device)
         self.on = False
 
     def start(self):
@@ -644,10 +1666,13 @@ class MQbme(polyinterface.Node):
 
     def updateInfo(self, payload):
         try:
-            data = json.loads(payload)
+            data = self.decode(payload)
         except Exception as ex:
-            LOGGER.error(
-                "Failed to parse MQTT Payload as Json: {} {}".format(ex, payload)
+            self.log_error(
+                type(ex).__name__,
+                "Failed to parse MQTT Payload as Json: {} {}",
+                ex,
+                payload,
             )
             return False
         if "BME280" in data:
@@ -680,9 +1705,12 @@ class MQbme(polyinterface.Node):
 
 # This class is an attempt to add support for HC-SR04 Ultrasonic Sensor.
 # Returns distance in centimeters.
-class MQhcsr(polyinterface.Node):
+class MQhcsr(MQNode):
+    history = True
+    telemetry = True
+
     def __init__(self, controller, primary, address, name, device):
-        super().__init__(controller, primary, address, name)
+        super().__init__(controller, primary, address, name, device)
         self.on = False
 
     def start(self):
@@ -690,10 +1718,13 @@ class MQhcsr(polyinterface.Node):
 
     def updateInfo(self, payload):
         try:
-            data = json.loads(payload)
+            data = self.decode(payload)
         except Exception as ex:
-            LOGGER.error(
-                "Failed to parse MQTT Payload as Json: {} {}".format(ex, payload)
+            self.log_error(
+                type(ex).__name__,
+                "Failed to parse MQTT Payload as Json: {} {}",
+                ex,
+                payload,
             )
             return False
         if "SR04" in data:
@@ -719,9 +1750,11 @@ class MQhcsr(polyinterface.Node):
 # General purpose Analog input using ADC.
 # Setting max value in editor.xml as 1024, as that would be the max for
 # onboard ADC, but that might need to be changed for external ADCs.
-class MQAnalog(polyinterface.Node):
+class MQAnalog(MQNode):
+    telemetry = True
+
     def __init__(self, controller, primary, address, name, device):
-        super().__init__(controller, primary, address, name)
+        super().__init__(controller, primary, address, name, device)
         self.on = False
 
     def start(self):
@@ -729,10 +1762,13 @@ class MQAnalog(polyinterface.Node):
 
     def updateInfo(self, payload):
         try:
-            data = json.loads(payload)
+            data = self.decode(payload)
         except Exception as ex:
-            LOGGER.error(
-                "Failed to parse MQTT Payload as Json: {} {}".format(ex, payload)
+            self.log_error(
+                type(ex).__name__,
+                "Failed to parse MQTT Payload as Json: {} {}",
+                ex,
+                payload,
             )
             return False
         if "ANALOG" in data:
@@ -758,9 +1794,12 @@ class MQAnalog(polyinterface.Node):
 
 
 # Reading the telemetry data for a Sonoff S31 (use the switch for control)
-class MQs31(polyinterface.Node):
+class MQs31(MQNode):
+    history = True
+    telemetry = True
+
     def __init__(self, controller, primary, address, name, device):
-        super().__init__(controller, primary, address, name)
+        super().__init__(controller, primary, address, name, device)
         self.on = False
 
     def start(self):
@@ -768,10 +1807,13 @@ class MQs31(polyinterface.Node):
 
     def updateInfo(self, payload):
         try:
-            data = json.loads(payload)
+            data = self.decode(payload)
         except Exception as ex:
-            LOGGER.error(
-                "Failed to parse MQTT Payload as Json: {} {}".format(ex, payload)
+            self.log_error(
+                type(ex).__name__,
+                "Failed to parse MQTT Payload as Json: {} {}",
+                ex,
+                payload,
             )
             return False
         if "ENERGY" in data:
@@ -801,9 +1843,12 @@ class MQs31(polyinterface.Node):
     commands = {"QUERY": query}
 
 
-class MQraw(polyinterface.Node):
+class MQraw(MQNode):
+    structured = False
+    telemetry = True
+
     def __init__(self, controller, primary, address, name, device):
-        super().__init__(controller, primary, address, name)
+        super().__init__(controller, primary, address, name, device)
         self.cmd_topic = device["cmd_topic"]
         self.on = False
 
@@ -815,7 +1860,9 @@ class MQraw(polyinterface.Node):
             self.setDriver("ST", 1)
             self.setDriver("GV1", int(payload))
         except Exception as ex:
-            LOGGER.error("Failed to parse MQTT Payload: {} {}".format(ex, payload))
+            self.log_error(
+                type(ex).__name__, "Failed to parse MQTT Payload: {} {}", ex, payload
+            )
 
     def query(self, command=None):
         self.reportDrivers()
@@ -831,9 +1878,9 @@ class MQraw(polyinterface.Node):
 
 # Class for an RGBW strip powered through a microController running MQTT client
 # able to set colours and run different transition programs
-class MQRGBWstrip(polyinterface.Node):
+class MQRGBWstrip(MQNode):
     def __init__(self, controller, primary, address, name, device):
-        super().__init__(controller, primary, address, name)
+        super().__init__(controller, primary, address, name, device)
         self.cmd_topic = device["cmd_topic"]
         self.on = False
         self.motion = False
@@ -843,10 +1890,13 @@ class MQRGBWstrip(polyinterface.Node):
 
     def updateInfo(self, payload):
         try:
-            data = json.loads(payload)
+            data = self.decode(payload)
         except Exception as ex:
-            LOGGER.error(
-                "Failed to parse MQTT Payload as Json: {} {}".format(ex, payload)
+            self.log_error(
+                type(ex).__name__,
+                "Failed to parse MQTT Payload as Json: {} {}",
+                ex,
+                payload,
             )
             return False
 
@@ -872,10 +1922,10 @@ class MQRGBWstrip(polyinterface.Node):
                 self.setDriver("GV6", data["pgm"])
 
     def led_on(self, command):
-        self.controller.mqtt_pub(self.cmd_topic, json.dumps({"state": "ON"}))
+        self.controller.mqtt_pub(self.cmd_topic, self.codec.encode({"state": "ON"}))
 
     def led_off(self, command):
-        self.controller.mqtt_pub(self.cmd_topic, json.dumps({"state": "OFF"}))
+        self.controller.mqtt_pub(self.cmd_topic, self.codec.encode({"state": "OFF"}))
 
     def rgbw_set(self, command):
         query = command.get("query")
@@ -892,7 +1942,7 @@ class MQRGBWstrip(polyinterface.Node):
             "pgm": program,
         }
 
-        self.controller.mqtt_pub(self.cmd_topic, json.dumps(cmd))
+        self.controller.mqtt_pub(self.cmd_topic, self.codec.encode(cmd))
 
     def _check_limit(self, value):
         if value > 255: